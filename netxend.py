@@ -11,6 +11,14 @@ from PIL import Image, ImageTk
 import json
 from tkinter import filedialog, messagebox
 import hashlib
+import ctypes
+import ctypes.util
+import select
+import struct
+from stat import S_ISREG
+from contextlib import nullcontext
+import atexit
+import uuid
 
 # Theme and appearance settings
 ctk.set_appearance_mode("dark")
@@ -27,6 +35,42 @@ BROADCAST_ADDR = '255.255.255.255'
 
 PEER_TIMEOUT = 30  # Seconds before a peer is considered offline
 AUTO_SCAN_INTERVAL = 10000  # Milliseconds between automatic scans
+CONNECT_TIMEOUT = 5  # Seconds to wait when connecting to a peer
+
+# Folder sync settings
+SYNC_STATE_FILE = "netxend_sync_state.json"
+SYNC_POLL_INTERVAL = 2  # Seconds between snapshots when inotify is unavailable
+SYNC_DEBOUNCE = 1.5  # Seconds a file must stay unchanged before it is sent
+SYNC_MAX_BACKOFF = 300  # Longest wait in seconds before retrying a file that failed to send
+
+# inotify event masks (see <sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# Admission control for incoming transfers
+MAX_INCOMING_TRANSFERS = 4  # Concurrent incoming transfers across all peers
+MAX_INCOMING_PER_PEER = 2  # Concurrent incoming transfers from a single peer
+ADMISSION_RETRY_AFTER = 5  # Seconds a busy receiver asks the sender to wait
+ADMISSION_MAX_RETRIES = 12  # Times a sender retries a busy receiver before giving up
+ADMISSION_REPLY_TIMEOUT = 5  # Seconds a sender waits for the admission reply
+TRANSFER_TIMEOUT = 60  # Seconds without data before a stalled transfer is abandoned
+DISK_SPACE_MARGIN = 64 * 1024 * 1024  # Bytes always left free in SAVE_FOLDER
+
+# Tracing settings
+TRACE_ENV = "NETXEND_TRACE"  # Set to an output path to record a Chrome trace
+TRACE_BATCH_SIZE = 1024 * 1024  # Bytes covered by each traced read/send or recv/write span
+TRACE_MAX_EVENTS = 500000  # Spans kept in memory before new ones are dropped
+TRACE_RESERVED_EVENTS = 10000  # Part of TRACE_MAX_EVENTS kept free of batch and UI spans
 
 # Default user settings
 DEFAULT_CONFIG = {
@@ -49,6 +93,28 @@ def save_config(config):
     with open(CONFIG_FILE, 'w') as f:
         json.dump(config, f)
 
+sync_state_lock = threading.Lock()
+
+def load_sync_state():
+    """Load the record of files already synced to each peer"""
+    if os.path.exists(SYNC_STATE_FILE):
+        try:
+            with open(SYNC_STATE_FILE, 'r') as f:
+                return json.load(f)
+        except:
+            pass
+    return {}
+
+def save_sync_record(key, name, signature):
+    """Record one synced file, merging into the saved state and replacing it atomically"""
+    with sync_state_lock:
+        state = load_sync_state()
+        state.setdefault(key, {})[name] = signature
+        tmp_file = f"{SYNC_STATE_FILE}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_file, SYNC_STATE_FILE)
+
 # Cross-platform setup
 def get_downloads_path():
     system = platform.system()
@@ -64,6 +130,355 @@ if not SAVE_FOLDER.exists():
 peers = {}
 selected_peer = None
 transfer_queue = []
+send_slots = {}  # peer ip -> semaphore limiting our concurrent sends to it
+send_slots_lock = threading.Lock()
+
+def peer_send_slot(ip):
+    """Semaphore that keeps sends to one peer within its per-peer admission limit"""
+    with send_slots_lock:
+        if ip not in send_slots:
+            send_slots[ip] = threading.BoundedSemaphore(MAX_INCOMING_PER_PEER)
+        return send_slots[ip]
+
+class Tracer:
+    """Record transfer timing spans and export them in Chrome trace format"""
+
+    def __init__(self, output_path=None):
+        self.output_path = output_path
+        self.enabled = bool(output_path)
+        self.events = []
+        self.dropped = 0
+        self.thread_names = {}
+        self.origin = time.perf_counter()
+
+    def now(self):
+        """Microseconds since the tracer was created"""
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def record(self, name, start, end, transfer_id=None, bulk=False, **args):
+        """Store a completed span; start and end come from now()
+
+        Bulk spans (batches, UI callbacks) stop short of TRACE_MAX_EVENTS so
+        connect, header, admission and ACK spans always have room.
+        """
+        limit = TRACE_MAX_EVENTS - TRACE_RESERVED_EVENTS if bulk else TRACE_MAX_EVENTS
+        if len(self.events) >= limit:
+            self.dropped += 1
+            return
+        tid = threading.get_native_id()
+        if tid not in self.thread_names:
+            self.thread_names[tid] = threading.current_thread().name
+        if transfer_id is not None:
+            args['transfer_id'] = transfer_id
+        # list.append is atomic, so worker threads can record without a lock
+        self.events.append({
+            "name": name,
+            "cat": "netxend",
+            "ph": "X",
+            "ts": start,
+            "dur": end - start,
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": args
+        })
+
+    def span(self, name, transfer_id=None, **args):
+        """Context manager timing a block; a shared no-op when tracing is off"""
+        if not self.enabled:
+            return NULL_SPAN
+        return TraceSpan(self, name, transfer_id, args)
+
+    def wrap_callback(self, name, func, transfer_id=None, delay_ms=0):
+        """Wrap a Tk callback to trace both its time in the event queue and its run time
+
+        delay_ms is the delay passed to after(), so the queued span starts when
+        the callback becomes due rather than when it was scheduled.
+        """
+        if not self.enabled:
+            return func
+        queued = self.now() + delay_ms * 1000
+
+        def traced(*a, **kw):
+            start = self.now()
+            self.record(f"{name} (queued)", min(queued, start), start, transfer_id, bulk=True)
+            try:
+                return func(*a, **kw)
+            finally:
+                self.record(name, start, self.now(), transfer_id, bulk=True)
+        return traced
+
+    def export(self, path=None):
+        """Write the recorded spans as Chrome trace JSON (Perfetto, about:tracing)"""
+        path = path or self.output_path
+        if not path:
+            return
+        pid = os.getpid()
+        metadata = [{
+            "name": "thread_name",
+            "ph": "M",
+            "pid": pid,
+            "tid": tid,
+            "args": {"name": thread_name}
+        } for tid, thread_name in list(self.thread_names.items())]
+        with open(path, 'w') as f:
+            json.dump({
+                "traceEvents": metadata + list(self.events),
+                "displayTimeUnit": "ms",
+                "otherData": {"dropped_events": self.dropped}
+            }, f)
+
+class TraceSpan:
+    def __init__(self, tracer, name, transfer_id, args):
+        self.tracer = tracer
+        self.name = name
+        self.transfer_id = transfer_id
+        self.args = args
+
+    def __enter__(self):
+        self.start = self.tracer.now()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = repr(exc)
+        self.tracer.record(self.name, self.start, self.tracer.now(), self.transfer_id, **self.args)
+        return False
+
+NULL_SPAN = nullcontext()
+tracer = Tracer(os.environ.get(TRACE_ENV))
+if tracer.enabled:
+    atexit.register(tracer.export)
+
+class Reservation:
+    def __init__(self, peer_ip, size):
+        self.peer_ip = peer_ip
+        self.size = size
+        self.written = 0
+
+class AdmissionController:
+    """Decide which incoming transfers may start and keep disk space reserved for them"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.reservations = []
+        # Temp files left by transfers interrupted by a crash still take up disk space
+        for leftover in Path(folder).glob(".*.part"):
+            try:
+                leftover.unlink()
+            except OSError:
+                pass
+
+    def admit(self, peer_ip, size):
+        """Return (status, detail): ("ok", Reservation), ("busy", retry_after) or ("rejected", reason)"""
+        with self.lock:
+            per_peer = sum(1 for r in self.reservations if r.peer_ip == peer_ip)
+            if len(self.reservations) >= MAX_INCOMING_TRANSFERS or per_peer >= MAX_INCOMING_PER_PEER:
+                return "busy", ADMISSION_RETRY_AFTER
+
+            # Space already promised to running transfers is not free yet
+            outstanding = sum(max(r.size - r.written, 0) for r in self.reservations)
+            free = shutil.disk_usage(self.folder).free - outstanding - DISK_SPACE_MARGIN
+            if size > free:
+                return "rejected", f"not enough disk space ({size} bytes needed, {max(free, 0)} available)"
+
+            reservation = Reservation(peer_ip, size)
+            self.reservations.append(reservation)
+            return "ok", reservation
+
+    def release(self, reservation):
+        with self.lock:
+            if reservation in self.reservations:
+                self.reservations.remove(reservation)
+
+    def commit(self, temp_path, save_path):
+        """Move a completed download into place; the newest complete copy wins"""
+        with self.lock:
+            os.replace(temp_path, save_path)
+
+def recv_line(sock, limit=1024):
+    """Read a newline-terminated message without consuming bytes past it"""
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(1)
+        if not chunk:
+            break
+        data += chunk
+        if len(data) > limit:
+            raise ValueError("Reply too long")
+    return data.decode().strip()
+
+class FolderWatcher:
+    """Watch a local folder and send new or changed files to a peer"""
+
+    def __init__(self, folder, peer_ip, send_callback, status_callback=None):
+        self.folder = os.path.abspath(folder)
+        self.peer_ip = peer_ip
+        self.send_callback = send_callback
+        self.status_callback = status_callback or (lambda text: None)
+        self.state_key = f"{self.folder}|{peer_ip}"
+        self.synced = load_sync_state().get(self.state_key, {})
+        self.pending = {}  # name -> (signature, time first seen with that signature)
+        self.failures = {}  # name -> consecutive failed sends
+        self.writing = set()  # names inotify reports as still open for writing
+        self.inotify_fd = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.inotify_fd = self.init_inotify()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def init_inotify(self):
+        """Return an inotify descriptor watching the folder, or None to fall back to polling"""
+        if platform.system() != "Linux":
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+            if libc.inotify_add_watch(fd, os.fsencode(self.folder), mask) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError):
+            return None
+
+    def snapshot(self):
+        """Map each regular file in the folder to its (size, mtime) signature"""
+        files = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                files[entry.name] = [st.st_size, st.st_mtime_ns]
+        return files
+
+    def stat_names(self, names, files):
+        """Refresh the signatures of the given names in an existing snapshot"""
+        for name in names:
+            if name.startswith("."):
+                continue
+            try:
+                st = os.stat(os.path.join(self.folder, name), follow_symlinks=False)
+            except OSError:
+                files.pop(name, None)
+                continue
+            if S_ISREG(st.st_mode):
+                files[name] = [st.st_size, st.st_mtime_ns]
+
+    def wait_for_changes(self, timeout):
+        """Block until inotify reports events; return the changed names or None for a full rescan"""
+        readable, _, _ = select.select([self.inotify_fd], [], [], timeout)
+        if not readable:
+            return set()
+        names = set()
+        try:
+            while True:
+                buf = os.read(self.inotify_fd, 64 * 1024)
+                offset = 0
+                while offset < len(buf):
+                    _, mask, _, length = INOTIFY_EVENT.unpack_from(buf, offset)
+                    offset += INOTIFY_EVENT.size
+                    if mask & IN_Q_OVERFLOW:
+                        return None
+                    if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                        # The watch is gone, so no further events will arrive
+                        raise FileNotFoundError(f"{self.folder} was removed or moved")
+                    name = buf[offset:offset + length].rstrip(b"\0")
+                    offset += length
+                    if not name:
+                        continue
+                    name = os.fsdecode(name)
+                    names.add(name)
+                    # A file stays "being written" from its first write until the writer closes it;
+                    # IN_CREATE alone doesn't count, hard links and read-only opens never close-write
+                    if mask & IN_MODIFY:
+                        self.writing.add(name)
+                    if mask & (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE):
+                        self.writing.discard(name)
+        except BlockingIOError:
+            pass
+        return names
+
+    def ready_files(self, files):
+        """Return files whose signature changed since the last sync and has since settled"""
+        now = time.monotonic()
+        ready = []
+        for name in list(self.pending):
+            if name not in files:
+                del self.pending[name]
+                self.failures.pop(name, None)
+        for name, signature in files.items():
+            if self.synced.get(name) == signature:
+                self.pending.pop(name, None)
+                continue
+            seen = self.pending.get(name)
+            if seen is None or seen[0] != signature:
+                self.pending[name] = (signature, now)
+                self.failures.pop(name, None)
+            elif name in self.writing:
+                self.pending[name] = (signature, now)
+            elif now - seen[1] >= SYNC_DEBOUNCE:
+                ready.append(name)
+        return ready
+
+    def run(self):
+        try:
+            files = self.snapshot()
+        except OSError as e:
+            self.status_callback(f"Sync error: {e}")
+            return
+        mode = "inotify" if self.inotify_fd is not None else "polling"
+        self.status_callback(f"Syncing {os.path.basename(self.folder)} ({mode})")
+
+        try:
+            while not self.stop_event.is_set():
+                for name in self.ready_files(files):
+                    if self.stop_event.is_set():
+                        break
+                    signature = files[name]
+                    if self.send_callback(os.path.join(self.folder, name), self.peer_ip, self.stop_event):
+                        self.pending.pop(name, None)
+                        self.failures.pop(name, None)
+                        self.synced[name] = signature
+                        save_sync_record(self.state_key, name, signature)
+                    else:
+                        # Back off so an offline peer isn't retried every debounce interval
+                        failures = self.failures.get(name, 0) + 1
+                        self.failures[name] = failures
+                        delay = min(SYNC_DEBOUNCE * 2 ** failures, SYNC_MAX_BACKOFF)
+                        self.pending[name] = (signature, time.monotonic() + delay)
+
+                timeout = SYNC_DEBOUNCE if self.pending else SYNC_POLL_INTERVAL
+                if self.inotify_fd is None:
+                    self.stop_event.wait(timeout)
+                    files = self.snapshot()
+                    continue
+
+                names = self.wait_for_changes(timeout)
+                if names is None:
+                    self.writing.clear()
+                    files = self.snapshot()
+                else:
+                    self.stat_names(names, files)
+        except OSError as e:
+            self.status_callback(f"Sync error: {e}")
+        finally:
+            if self.inotify_fd is not None:
+                os.close(self.inotify_fd)
+                self.inotify_fd = None
 
 class UserFrame(ctk.CTkFrame):
     def __init__(self, master, username, is_self=False, avatar_color=None, **kwargs):
@@ -222,6 +637,7 @@ class NetXendApp(ctk.CTk):
         # Load icon
         self.load_icon()
         self.setup_ui()
+        self.admission = AdmissionController(SAVE_FOLDER)
         self.start_network_services()
          # Add peer timestamps dictionary
         self.peer_timestamps = {}
@@ -376,6 +792,16 @@ class NetXendApp(ctk.CTk):
         )
         self.scan_button.grid(row=1, column=1, padx=10, pady=5)
 
+        # Sync folder button
+        self.folder_watcher = None
+        self.sync_button = ctk.CTkButton(
+            self.controls_frame,
+            text="Sync Folder",
+            width=120,
+            command=self.toggle_folder_sync
+        )
+        self.sync_button.grid(row=1, column=2, padx=(0, 10), pady=5)
+
        
 
        
@@ -413,6 +839,43 @@ class NetXendApp(ctk.CTk):
                 daemon=True
             ).start()
 
+    def toggle_folder_sync(self):
+        """Start or stop mirroring a folder to the selected peer"""
+        if self.folder_watcher:
+            self.folder_watcher.stop()
+            # A new sync can't start until the old thread has finished its current send
+            self.sync_button.configure(state="disabled", text="Stopping...")
+            return
+
+        if not selected_peer:
+            messagebox.showwarning("No Peer Selected", "Please select a peer first!")
+            return
+
+        folder = filedialog.askdirectory()
+        if not folder:
+            return
+
+        self.folder_watcher = FolderWatcher(
+            folder,
+            selected_peer,
+            self.send_file,
+            lambda text: self.after(0, lambda: self.status_label.configure(text=text))
+        )
+        self.folder_watcher.start()
+        self.sync_button.configure(text="Stop Sync")
+        self.after(500, self.check_folder_sync)
+
+    def check_folder_sync(self):
+        """Reset the sync button once the watcher thread has exited, whether stopped or failed"""
+        watcher = self.folder_watcher
+        if watcher.thread.is_alive():
+            self.after(500, self.check_folder_sync)
+            return
+        self.folder_watcher = None
+        self.sync_button.configure(state="normal", text="Sync Folder")
+        if watcher.stop_event.is_set():
+            self.status_label.configure(text="Folder sync stopped")
+
     def update_progress(self, value, status_text=""):
         self.progress_bar.set(value / 100)
         if status_text:
@@ -591,71 +1054,211 @@ class NetXendApp(ctk.CTk):
             time.sleep(1)
             self.after(100, self.update_peers_list)
 
-    def receive_file(self, conn):
+    def receive_file(self, conn, addr):
+        reservation = None
+        temp_path = None
         try:
+            # Recorded by hand: the transfer ID is only known once the header is parsed
+            header_start = tracer.now() if tracer.enabled else 0
             file_info = conn.recv(1024).decode()
             file_info = json.loads(file_info)
-            file_name = file_info['name']
-            total_size = file_info['size']
+            name = file_info.get('name')
+            file_name = Path(name).name if isinstance(name, str) else ""
+            total_size = file_info.get('size')
+            transfer_id = file_info.get('transfer_id') or uuid.uuid4().hex[:8]
+            if tracer.enabled:
+                tracer.record("header exchange", header_start, tracer.now(), transfer_id, file=file_name)
+
+            if file_name in ("", ".", "..") or "\0" in file_name:
+                status, detail = "rejected", "invalid file name"
+            elif not isinstance(total_size, int) or isinstance(total_size, bool) or total_size < 0:
+                status, detail = "rejected", "invalid file size"
+            else:
+                with tracer.span("admission", transfer_id, peer=addr[0]):
+                    status, detail = self.admission.admit(addr[0], total_size)
+            if status == "ok":
+                reservation = detail
+                reply = {"status": "ok"}
+            elif status == "busy":
+                reply = {"status": "busy", "retry_after": detail}
+            else:
+                reply = {"status": "rejected", "reason": detail}
+            # Older senders don't wait for a reply; they only see the connection close
+            if file_info.get('admission'):
+                conn.sendall((json.dumps(reply) + "\n").encode())
+            if reservation is None:
+                self.status_label.configure(text=f"Declined {file_name} from {addr[0]} ({status})")
+                return
             
             save_path = SAVE_FOLDER / file_name
+            # Unique hidden name so concurrent receives of the same file never share a file
+            temp_path = SAVE_FOLDER / f".{file_name}.{uuid.uuid4().hex}.part"
             received = 0
             
-            with open(save_path, 'wb') as f:
+            tracing = tracer.enabled
+            batch_start = batch_bytes = recv_time = write_time = 0
+            with open(temp_path, 'wb') as f:
                 while received < total_size:
+                    if tracing:
+                        t0 = tracer.now()
+                        if not batch_bytes:
+                            batch_start = t0
                     data = conn.recv(BUFFER_SIZE)
                     if not data:
                         break
+                    if tracing:
+                        t1 = tracer.now()
                     f.write(data)
                     received += len(data)
+                    reservation.written = received
+                    if tracing:
+                        t2 = tracer.now()
+                        recv_time += t1 - t0
+                        write_time += t2 - t1
+                        batch_bytes += len(data)
+                        if batch_bytes >= TRACE_BATCH_SIZE or received >= total_size:
+                            tracer.record("recv/write batch", batch_start, t2, transfer_id,
+                                          bytes=batch_bytes, recv_us=recv_time, write_us=write_time, bulk=True)
+                            batch_bytes = recv_time = write_time = 0
                     progress = received / total_size * 100
-                    self.after(10, lambda: self.update_progress(
+                    update = lambda: self.update_progress(
                         progress,
                         f"Receiving: {file_name} ({progress:.1f}%)"
-                    ))
+                    )
+                    # Trace one UI callback per batch, not one per chunk
+                    if tracing and not batch_bytes:
+                        update = tracer.wrap_callback("ui update_progress", update, transfer_id, delay_ms=10)
+                    self.after(10, update)
+
+            if received < total_size:
+                raise ConnectionError(f"connection closed after {received} of {total_size} bytes")
+            self.admission.commit(temp_path, save_path)
+            temp_path = None
+            # Free the slot before the ACK so the sender's next file is admitted
+            self.admission.release(reservation)
+            reservation = None
 
-            conn.sendall(b'ACK')
+            with tracer.span("send ack", transfer_id):
+                conn.sendall(b'ACK')
             self.status_label.configure(text=f"Received: {file_name}")
             
         except Exception as e:
             self.status_label.configure(text=f"Error receiving file: {str(e)}")
             print(f"Receive error: {e}")
         finally:
+            if temp_path is not None and temp_path.exists():
+                temp_path.unlink()
+            if reservation is not None:
+                self.admission.release(reservation)
             conn.close()
 
-    def send_file(self, file_path, ip):
+    def send_file(self, file_path, ip, cancel_event=None):
+        transfer_id = uuid.uuid4().hex[:8]
+        file_name = os.path.basename(file_path)
+        cancel_event = cancel_event or threading.Event()
         try:
+            # Extra files wait here instead of being turned away by the receiver
+            slot = peer_send_slot(ip)
+            while not slot.acquire(timeout=1):
+                if cancel_event.is_set():
+                    return False
+            try:
+                return self.request_send(file_path, file_name, ip, transfer_id, cancel_event)
+            finally:
+                slot.release()
+        except Exception as e:
+            self.status_label.configure(text=f"Error sending file: {str(e)}")
+            print(f"Send error: {e}")
+        return False
+
+    def request_send(self, file_path, file_name, ip, transfer_id, cancel_event):
+        """Offer the file until the receiver admits it, retrying busy replies a limited number of times"""
+        for attempt in range(ADMISSION_MAX_RETRIES + 1):
+            if cancel_event.is_set():
+                return False
+            retry_after = None
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.connect((ip, PORT))
-                file_name = os.path.basename(file_path)
+                sock.settimeout(CONNECT_TIMEOUT)
+                with tracer.span("connect", transfer_id, peer=ip):
+                    sock.connect((ip, PORT))
                 file_size = os.path.getsize(file_path)
                 
-                # Send file metadata
+                # Send file metadata and wait for the receiver to admit the transfer
                 file_info = {
                     'name': file_name,
-                    'size': file_size
+                    'size': file_size,
+                    'transfer_id': transfer_id,
+                    'admission': True
                 }
-                sock.sendall(json.dumps(file_info).encode())
-                time.sleep(0.1)
-
-                sent = 0
-                with open(file_path, 'rb') as f:
-                    while sent < file_size:
-                        data = f.read(BUFFER_SIZE)
-                        sock.sendall(data)
-                        sent += len(data)
-                        progress = sent / file_size * 100
-                        self.after(10, lambda: self.update_progress(
-                            progress,
-                            f"Sending: {file_name} ({progress:.1f}%)"
-                        ))
-
-                if sock.recv(3) == b'ACK':
-                    self.status_label.configure(text=f"Sent: {file_name}")
-                    
-        except Exception as e:
-            self.status_label.configure(text=f"Error sending file: {str(e)}")
-            print(f"Send error: {e}")
+                with tracer.span("header exchange", transfer_id, file=file_name):
+                    sock.sendall(json.dumps(file_info).encode())
+                    sock.settimeout(ADMISSION_REPLY_TIMEOUT)
+                    try:
+                        reply = json.loads(recv_line(sock) or '{}')
+                    except socket.timeout:
+                        # Receivers without admission control never reply
+                        reply = {'status': 'ok'}
+                    sock.settimeout(TRANSFER_TIMEOUT)
+
+                status = reply.get('status')
+                if status == 'busy':
+                    if attempt == ADMISSION_MAX_RETRIES:
+                        raise ConnectionError(f"receiver still busy after {ADMISSION_MAX_RETRIES} retries")
+                    retry_after = reply.get('retry_after', ADMISSION_RETRY_AFTER)
+                elif status != 'ok':
+                    raise ConnectionError(reply.get('reason') or "receiver declined the transfer")
+                else:
+                    return self.stream_file(sock, file_path, file_name, file_size, transfer_id, cancel_event)
+
+            self.status_label.configure(text=f"Receiver busy, retrying {file_name} in {retry_after}s")
+            with tracer.span("admission wait", transfer_id):
+                cancel_event.wait(retry_after)
+
+    def stream_file(self, sock, file_path, file_name, file_size, transfer_id, cancel_event):
+        """Send the file body over an admitted connection and wait for the ACK"""
+        sent = 0
+        tracing = tracer.enabled
+        batch_start = batch_bytes = read_time = send_time = 0
+        with open(file_path, 'rb') as f:
+            while sent < file_size:
+                if tracing:
+                    t0 = tracer.now()
+                    if not batch_bytes:
+                        batch_start = t0
+                data = f.read(BUFFER_SIZE)
+                if not data:
+                    raise OSError(f"{file_name} shrank while it was being sent")
+                if cancel_event.is_set():
+                    raise ConnectionError("send cancelled")
+                if tracing:
+                    t1 = tracer.now()
+                sock.sendall(data)
+                sent += len(data)
+                if tracing:
+                    t2 = tracer.now()
+                    read_time += t1 - t0
+                    send_time += t2 - t1
+                    batch_bytes += len(data)
+                    if batch_bytes >= TRACE_BATCH_SIZE or sent >= file_size:
+                        tracer.record("read/send batch", batch_start, t2, transfer_id,
+                                      bytes=batch_bytes, read_us=read_time, send_us=send_time, bulk=True)
+                        batch_bytes = read_time = send_time = 0
+                progress = sent / file_size * 100
+                update = lambda: self.update_progress(
+                    progress,
+                    f"Sending: {file_name} ({progress:.1f}%)"
+                )
+                # Trace one UI callback per batch, not one per chunk
+                if tracing and not batch_bytes:
+                    update = tracer.wrap_callback("ui update_progress", update, transfer_id, delay_ms=10)
+                self.after(10, update)
+
+        with tracer.span("ack wait", transfer_id):
+            ack = sock.recv(3)
+        if ack == b'ACK':
+            self.status_label.configure(text=f"Sent: {file_name}")
+            return True
+        return False
 
     def start_network_services(self):
         def discovery_listener():
@@ -702,9 +1305,11 @@ class NetXendApp(ctk.CTk):
                 sock.listen()
                 while True:
                     conn, addr = sock.accept()
+                    # A sender that stalls mid-stream must not hold its reservation forever
+                    conn.settimeout(TRANSFER_TIMEOUT)
                     threading.Thread(
                         target=self.receive_file,
-                        args=(conn,),
+                        args=(conn, addr),
                         daemon=True
                     ).start()
 